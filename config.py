@@ -72,8 +72,23 @@ _GROUP_HDR_TXT = """A boolean setting. If true, the commits for
  5 commits to our-game". A line like "Talking about fa1afe1?" is displayed
  before presenting data for a commit id found in the irc conversation."""
 
-_TIMEOUT_TXT = """Max time for fetch operations (seconds). A value of 0
-disables timeout for this repo completely"""
+_TIMEOUT_TXT = """Max time for fetch operations (seconds). A git command
+running longer than this is killed. A value of 0 disables timeout for this
+repo completely"""
+
+_STORE_TXT = """Name of a local object store shared with other repositories,
+ typically forks of the same upstream. Repositories using the same name
+ keep their objects once, in repoDir/.stores/<name>. Empty means a separate
+ clone. Used when the repository is cloned."""
+
+_POLL_TXT = """How often (in seconds) this repository is fetched and polled
+ for changes. Zero means using the global pollPeriod. With adaptivePolling
+ this is only the initial value."""
+
+
+class _FetchEngine(registry.OnlySomeStrings):
+    ''' The fetchEngine option values. '''
+    validStrings = ('threads', 'events')
 
 
 _REPO_OPTIONS = {
@@ -97,6 +112,10 @@ _REPO_OPTIONS = {
         lambda: registry.Boolean(True, _GROUP_HDR_TXT),
     'fetchTimeout':
         lambda: registry.Integer(60, _TIMEOUT_TXT),
+    'objectStore':
+        lambda: registry.String('', _STORE_TXT),
+    'pollPeriod':
+        lambda: registry.NonNegativeInteger(0, _POLL_TXT),
 }
 
 
@@ -165,6 +184,75 @@ conf.registerGlobalValue(Git, 'maxCommitsAtOnce',
 
 conf.registerGlobalValue(Git, 'fetchTimeout',
     registry.NonNegativeInteger(300, """Max time for fetch operations
-       (seconds)."""))
+       (seconds). Repositories not fetched when this time has elapsed
+       are skipped until next poll. Zero means no limit."""))
+
+conf.registerGlobalValue(Git, 'fetchWorkers',
+    registry.PositiveInteger(4, """Number of repositories fetched
+  concurrently from their remotes."""))
+
+conf.registerGlobalValue(Git, 'fetchesPerHost',
+    registry.NonNegativeInteger(2, """Max number of concurrent fetches
+  from the same remote host. Zero means no limit. Local repositories
+  (plain paths) are not limited."""))
+
+conf.registerGlobalValue(Git, 'probeBeforeFetch',
+    registry.Boolean(True, """If true, the remote branches are listed
+  (git ls-remote) before fetching a repository, and the fetch is skipped
+  unless a watched branch has moved."""))
+
+conf.registerGlobalValue(Git, 'maxBackoff',
+    registry.NonNegativeInteger(3600, """Max time (seconds) between fetch
+  attempts for a failing repository. The time between attempts starts at
+  pollPeriod and is doubled for each consecutive failure until this limit
+  is reached."""))
+
+conf.registerGlobalValue(Git, 'commitCacheSize',
+    registry.NonNegativeInteger(1000, """Max number of commits kept in
+  memory for each repository, avoiding repeated reads of the same commits
+  when polling, snarfing and running repolog. Zero disables the cache."""))
+
+conf.registerGlobalValue(Git, 'cloneFilter',
+    registry.String('blob:none', """Partial clone filter used when cloning
+  remote repositories, e. g. blob:none (no file contents) or tree:0 (no
+  file contents or trees). Missing objects are fetched when needed, like
+  for the %d and %f message codes. Empty means a full clone. Local clones
+  are bare but never filtered."""))
+
+conf.registerGlobalValue(Git, 'adaptivePolling',
+    registry.Boolean(False, """If true, the time between fetches of each
+  repository adapts to its activity. It's halved after fetches bringing
+  new commits and grows by half after fetches which don't, within
+  minPollPeriod and maxPollPeriod."""))
+
+conf.registerGlobalValue(Git, 'minPollPeriod',
+    registry.NonNegativeInteger(30, """Shortest time (seconds) between
+  fetches of a repository when adaptivePolling is true."""))
+
+conf.registerGlobalValue(Git, 'maxPollPeriod',
+    registry.NonNegativeInteger(3600, """Longest time (seconds) between
+  fetches of a repository when adaptivePolling is true."""))
+
+conf.registerGlobalValue(Git, 'pollJitter',
+    registry.NonNegativeInteger(10, """Random part (percent) of the poll
+  period by which each fetch is made earlier, so that repositories are not
+  all fetched at the same time."""))
+
+conf.registerGlobalValue(Git, 'notifyPort',
+    registry.NonNegativeInteger(0, """TCP port where push notifications are
+  received over HTTP, e. g. from a post-receive hook or a webhook. A notified
+  repository is fetched and polled right away. Zero disables the listener.
+  Use `reload Git` after changing this."""))
+
+conf.registerGlobalValue(Git, 'notifyAddress',
+    registry.String('127.0.0.1', """Address the push notification listener
+  binds to, see notifyPort. The listener does not authenticate senders."""))
+
+conf.registerGlobalValue(Git, 'fetchEngine',
+    _FetchEngine('threads', """How repositories are fetched: 'threads' runs
+  each git fetch in a worker thread, 'events' runs the git processes from a
+  single thread reading their output as it comes, scaling better to many
+  concurrent fetches. In both cases fetchWorkers limits the number of
+  concurrent fetches."""))
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -32,13 +32,17 @@ A Supybot plugin that monitors and interacts with git repositories.
 See README for configuration and usage.
 
 This code is threaded. A separate thread run the potential long-running
-replication of remote git repositories to local clones. The rest is handled
-by the main thread.
+replication of remote git repositories to local clones, and the following
+search for new commits. The rest is handled by the main thread.
 
 A special case of long-running operation is the creation of new repositories,
 This is done in a separate thread. The repository involved in this is not
 visible for any other thread until cloning is completed.
 
+Likewise, repositories which can't be restored from the saved heads at
+startup are initialized in background threads. These are visible while
+doing so, but flagged as warming up and ignored by most operations.
+
 The critical sections are:
    - The _Repository instances, locked with an instance attribute lock.
    - The Repos instance (repos) in the Git plugin, locked by a
@@ -49,9 +53,21 @@ See: The supybot docs, notably ADVANCED_PLUGIN_CONFIG.rst and
      ADVANCED_PLUGIN_TESTING.rst.
 """
 
+import BaseHTTPServer
+import bisect
+import collections
+import errno
 import fnmatch
+import heapq
+import json
 import os
+import random
+import select
 import shutil
+import signal
+import socket
+import subprocess
+import urllib
 
 from supybot import callbacks
 from supybot import ircmsgs
@@ -83,65 +99,368 @@ class GitPluginException(Exception):
     pass
 
 
-def _format_message(ctx, commit, branch='unknown'):
+class GitTimeoutError(GitPluginException):
+    ''' A git command was killed after running out of time. '''
+    pass
+
+
+class GitFetchSkipped(GitPluginException):
+    ''' A repository is not fetched in this run, not being at fault. '''
+    pass
+
+
+class _CommitList(list):
+    '''
+    A list of the newest commits in a range, total is the range size
+    and head the hexsha of the branch head the range ends with.
+    '''
+
+    def __init__(self, commits, total=None, head=None):
+        list.__init__(self, commits)
+        self.total = len(self) if total is None else total
+        self.head = head
+
+
+class _TimedLock(object):
+    '''
+    A lock used as a context manager, keeping statistics on how long
+    it's held and how long threads wait for it.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self.count = 0
+        self.held = 0.0
+        self.max_held = 0.0
+        self.waited = 0.0
+
+    def acquire(self, blocking=True):
+        ''' Acquire the lock, returns False if busy and not blocking. '''
+        start = time.time()
+        if not self._lock.acquire(blocking):
+            return False
+        self._acquired = time.time()
+        self.waited += self._acquired - start
+        return True
+
+    def release(self):
+        ''' Release the lock. '''
+        held = time.time() - self._acquired
+        self.count += 1
+        self.held += held
+        self.max_held = max(self.max_held, held)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __str__(self):
+        count = self.count if self.count else 1
+        return "held %s, average %.1f ms, max %.1f ms, wait %.1f ms" % (
+            nItems(self.count, 'time'),
+            1000 * self.held / count,
+            1000 * self.max_held,
+            1000 * self.waited / count)
+
+
+class _CommitFields(dict):
     """
-    Generate an formatted message for IRC from the given commit, using
-    the format specified in the config. Returns a list of strings.
+    Substitution values for a commit, computed on first lookup. Fields
+    not used by the template are never read from the commit, and thus
+    never cause an object database read.
+    """
+    # pylint: disable=W0212
+
+    _GETTERS = {
+        'a': lambda f: f._commit.author_name,
+        'b': lambda f: f._branch,
+        'c': lambda f: f._commit.hexsha[0:7],
+        'C': lambda f: f._commit.hexsha,
+        'd': lambda f: '+%(insertions)d -%(deletions)d' % f._get_stats(),
+        'e': lambda f: f._commit.author_email,
+        'f': lambda f: str(f._get_stats()['files']),
+        'm': lambda f: f._commit.subject,
+        'n': lambda f: f._repository.name,
+        'u': lambda f: f._repository.options.url,
+    }
+    CODES = ''.join(_GETTERS.keys())
+
+    def __init__(self, repository, commit, branch):
+        dict.__init__(self)
+        self._repository = repository
+        self._commit = commit
+        self._branch = branch
+        self._stats = None
+
+    def _get_stats(self):
+        ''' Return the diffstat totals, computed by git at most once. '''
+        if self._stats is None:
+            self._stats = self._repository.get_stats(self._commit.hexsha)
+        return self._stats
+
+    def __missing__(self, code):
+        value = self._GETTERS[code](self)
+        self[code] = value
+        return value
+
+
+class _MessageTemplate(object):
     """
-    MODE_NORMAL = 0
-    MODE_SUBST = 1
-    MODE_COLOR = 2
-    subst = {
-        'a': commit.author.name,
-        'b': branch,
-        'c': commit.hexsha[0:7],
-        'C': commit.hexsha,
-        'e': commit.author.email,
-        'm': commit.message.split('\n')[0],
-        'n': ctx.repo.name,
+    A commitMessage/snarfMessage format compiled into lines of literal
+    text and substitution codes. The format is parsed once when the
+    repository options are built; rendering is a single join per line.
+    """
+    FIELDS = _CommitFields.CODES
+    STATIC = {
         'S': ' ',
-        'u': ctx.repo.options.url,
         'r': '\x0f',
         '!': '\x02',
         '%': '%',
     }
-    result = []
-    lines = ctx.format.split('\n')
-    for line in lines:
+
+    def __init__(self, fmt):
+        self.lines = [self._compile(line) for line in fmt.split('\n')]
+
+    @classmethod
+    def _compile(cls, line):
+        '''
+        Parse a format line into a list of (is_field, text) tuples. text
+        is a substitution code if is_field, else literal text.
+        '''
+        MODE_NORMAL = 0
+        MODE_SUBST = 1
+        MODE_COLOR = 2
+        parts = []
+        literal = ''
         mode = MODE_NORMAL
-        outline = ''
         for c in line:
             if mode == MODE_SUBST:
-                if c in subst.keys():
-                    outline += subst[c]
+                if c in cls.FIELDS:
+                    if literal:
+                        parts.append((False, literal))
+                        literal = ''
+                    parts.append((True, c))
+                    mode = MODE_NORMAL
+                elif c in cls.STATIC:
+                    literal += cls.STATIC[c]
                     mode = MODE_NORMAL
                 elif c == '(':
                     color = ''
                     mode = MODE_COLOR
                 else:
-                    outline += c
+                    literal += c
                     mode = MODE_NORMAL
             elif mode == MODE_COLOR:
                 if c == ')':
-                    outline += '\x03' + color
+                    literal += '\x03' + color
                     mode = MODE_NORMAL
                 else:
                     color += c
             elif c == '%':
                 mode = MODE_SUBST
             else:
-                outline += c
-        result.append(outline.encode('utf-8'))
-    return result
+                literal += c
+        if literal:
+            parts.append((False, literal))
+        return parts
+
+    def render(self, subst):
+        ''' Return list of lines, fields looked up in the subst dict. '''
+        return [''.join([subst[text] if is_field else text
+                             for is_field, text in line]).encode('utf-8')
+                    for line in self.lines]
+
+
+def _format_message(ctx, commit, branch='unknown'):
+    """
+    Generate an formatted message for IRC from the given commit, using
+    the format specified in the config. Returns a list of strings.
+    """
+    return ctx.format.render(_CommitFields(ctx.repo, commit, branch))
+
+
+def _run_git(path, args, stdin=None, timeout=0):
+    '''
+    Run git with args in path, feeding it the stdin string if given.
+    Returns output, raises GitCommandError on errors. If timeout is set
+    and expires, the git process group (including helpers like ssh) is
+    killed and GitTimeoutError raised.
+    '''
+    cmd = ['git'] + args
+    proc = subprocess.Popen(cmd,
+                            cwd = path,
+                            stdin = subprocess.PIPE,
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE,
+                            preexec_fn = os.setsid)
+    expired = []
+
+    def kill():
+        ''' Timer callback, kill the process group. '''
+        expired.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill) if timeout > 0 else None
+    if timer:
+        timer.start()
+    try:
+        out, err = proc.communicate(stdin)
+    finally:
+        if timer:
+            timer.cancel()
+    if expired:
+        raise GitTimeoutError("Timeout (%d s) in: %s" %
+                              (timeout, ' '.join(cmd)))
+    if proc.returncode != 0:
+        raise git.GitCommandError(cmd, proc.returncode, err)
+    return out
+
+
+class _GitProcess(object):
+    '''
+    A git command started without waiting for it to complete, like
+    _run_git otherwise. The caller reads the output with read() when
+    poll() finds it ready. The process group is killed by
+    check_timeout() if it runs longer than timeout.
+    '''
+
+    def __init__(self, path, args, timeout=0):
+        self.cmd = ['git'] + args
+        self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout > 0 else None
+        self.timed_out = False
+        with open(os.devnull) as devnull:
+            self._proc = subprocess.Popen(self.cmd,
+                                          cwd = path,
+                                          stdin = devnull,
+                                          stdout = subprocess.PIPE,
+                                          stderr = subprocess.PIPE,
+                                          preexec_fn = os.setsid)
+        self._stdout = self._proc.stdout.fileno()
+        self._stderr = self._proc.stderr.fileno()
+        self._files = {self._stdout: self._proc.stdout,
+                       self._stderr: self._proc.stderr}
+        self._output = {self._stdout: [], self._stderr: []}
+
+    done = property(lambda self: not self._files,
+                    doc = 'True when all output has been read.')
+
+    def fds(self):
+        ''' Return list of file descriptors with output to read. '''
+        return self._files.keys()
+
+    def read(self, fd):
+        ''' Read available output from fd, closing it at end of file. '''
+        data = os.read(fd, 65536)
+        if data:
+            self._output[fd].append(data)
+        else:
+            self._files.pop(fd).close()
 
+    def check_timeout(self, now):
+        ''' Kill the process group if deadline has passed. '''
+        if self.deadline and now >= self.deadline and not self.timed_out:
+            self.timed_out = True
+            self.kill()
 
-def _get_branches(option_val, repo):
-    ''' Return list of branches in repo matching users's option_val. '''
+    def kill(self):
+        ''' Kill the process group. '''
+        try:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def wait(self):
+        ''' Wait for the process to exit, return exit code. '''
+        return self._proc.wait()
+
+    def result(self):
+        '''
+        Wait for the process to exit and return its output. Raises
+        GitTimeoutError or GitCommandError like _run_git.
+        '''
+        self.wait()
+        if self.timed_out:
+            raise GitTimeoutError("Timeout (%d s) in: %s" %
+                                  (self.timeout, ' '.join(self.cmd)))
+        out = ''.join(self._output[self._stdout])
+        err = ''.join(self._output[self._stderr])
+        if self._proc.returncode != 0:
+            raise git.GitCommandError(self.cmd, self._proc.returncode, err)
+        return out
+
+
+def _url_host(url):
+    ''' Return the lowercase host part of a git url, '' if local. '''
+    if '://' in url:
+        netloc = url.split('://', 1)[1].split('/', 1)[0]
+    elif ':' in url.split('/', 1)[0]:
+        netloc = url.split(':', 1)[0]     # scp-like: [user@]host:path
+    else:
+        return ''
+    return netloc.rsplit('@', 1)[-1].split(':', 1)[0].lower()
+
+
+def _normalize_url(url):
+    '''
+    Return url in a canonical form, the same for different spellings of
+    a remote: without trailing '/' or '.git', scp-like urls as ssh://
+    and lowercase scheme and host. Plain paths are made absolute.
+    '''
+    url = url.strip()
+    if not _url_host(url) and '://' not in url:
+        return os.path.abspath(url)
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    if '://' in url:
+        scheme, rest = url.split('://', 1)
+    else:
+        scheme, rest = 'ssh', url.replace(':', '/', 1)
+    netloc, path = (rest.split('/', 1) + [''])[0:2]
+    user, at, host = netloc.rpartition('@')
+    return '%s://%s%s%s/%s' % (scheme.lower(), user, at, host.lower(), path)
+
+
+_WEBHOOK_URL_KEYS = ['url', 'clone_url', 'git_url', 'ssh_url',
+                     'git_http_url', 'git_ssh_url']
+
+
+def _parse_notification(body):
+    '''
+    Parse the body of a push notification: a json webhook payload or
+    the input of a post-receive hook (old new ref lines). Returns tuple
+    (set of normalized repository urls, list of moved refs).
+    '''
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        refs = [line.split()[2] for line in body.splitlines()
+                    if len(line.split()) == 3]
+        return set(), refs
+    repository = data.get('repository')
+    if not isinstance(repository, dict):
+        repository = {}
+    urls = [repository.get(key) for key in _WEBHOOK_URL_KEYS]
+    urls = set([_normalize_url(u) for u in urls if isinstance(u, basestring)])
+    ref = data.get('ref')
+    return urls, [ref] if isinstance(ref, basestring) else []
+
+
+def _get_branches(option_val, repo_branches):
+    ''' Return list of repo_branches matching users's option_val. '''
     log_ = log.getPluginLogger('git.get_branches')
     opt_branches = [b.strip() for b in option_val.split()]
-    repo.remote().update()
-    repo_branches = \
-        [r.name.split('/')[1] for r in repo.remote().refs if r.is_detached]
     branches = []
     for opt in opt_branches:
         matched = fnmatch.filter(repo_branches, opt)
@@ -155,21 +474,31 @@ def _get_branches(option_val, repo):
 
 
 def _poll_all_repos(repolist, throw = False):
-    '''Find and store new commits in repo.new_commits_by_branch. '''
+    '''
+    Find new commits and advance the branch heads. Returns the list of
+    (irc, msg) notifications to send, which is done by _send_notifications
+    on main thread. Git operations should be done elsewhere.
+    '''
 
     def poll_repository(repository, targets):
-        ''' Perform poll of a repo, determine changes. '''
+        '''
+        Perform poll of a repo, determine changes. The lock is only held
+        while finding new commits and advancing the heads, formatting
+        is done without it.
+        '''
         with repository.lock:
             new_commits_by_branch = repository.get_new_commits()
-            for irc, channel in targets:
-                ctx = _DisplayCtx(irc, channel, repository)
-                ctx.display_commits(new_commits_by_branch)
-            for branch in new_commits_by_branch:
-                repository.commit_by_branch[branch] = \
-                   repository.get_commit(branch)
+            for branch, commits in new_commits_by_branch.iteritems():
+                repository.commit_by_branch[branch] = commits.head
+        lines = _DisplayCtx(None, None, repository).get_lines(
+                                                    new_commits_by_branch)
+        for irc, channel in targets:
+            for line in lines:
+                notifications.append((irc, ircmsgs.privmsg(channel, line)))
 
     start = time.time()
     _log = log.getPluginLogger('git.pollAllRepos')
+    notifications = []
     for repository in repolist:
         # Find the IRC/channel pairs to notify
         targets = []
@@ -181,6 +510,12 @@ def _poll_all_repos(repolist, throw = False):
             _log.info("Skipping %s: not in configured channel(s)." %
                           repository.name)
             continue
+        if repository.warming:
+            _log.debug("Skipping %s: warming up." % repository.name)
+            continue
+        if not throw and not repository.breaker.allow():
+            _log.debug("Skipping %s: fetch is failing." % repository.name)
+            continue
         try:
             poll_repository(repository, targets)
         except Exception as e:                      # pylint: disable=W0703
@@ -189,6 +524,236 @@ def _poll_all_repos(repolist, throw = False):
                 raise(e)
     _log.debug("Exiting poll_all_repos, elapsed: " +
                    str(time.time() - start))
+    return notifications
+
+
+def _send_notifications(notifications):
+    ''' Queue the (irc, msg) notifications from _poll_all_repos. '''
+    for irc, msg in notifications:
+        irc.queueMsg(msg)
+
+
+class _CommitRecord(object):
+    '''
+    The commit data used in messages, read once from a GitPython Commit
+    and not holding any reference to it.
+    '''
+    __slots__ = ('hexsha', 'author_name', 'author_email', 'subject',
+                 'authored_date', 'committed_date')
+
+    def __init__(self, commit):
+        self.hexsha = commit.hexsha
+        self.author_name = commit.author.name
+        self.author_email = commit.author.email
+        self.subject = commit.message.split('\n')[0]
+        self.authored_date = commit.authored_date
+        self.committed_date = commit.committed_date
+
+
+class _CommitCache(object):
+    '''
+    Bounded LRU cache of _CommitRecord by hexsha, with hit and miss
+    counters.
+    '''
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._records = collections.OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, hexsha, load):
+        '''
+        Return record for hexsha. On misses load(hexsha) is invoked to
+        create it, without holding the lock.
+        '''
+        with self._lock:
+            record = self._records.pop(hexsha, None)
+            if record:
+                self.hits += 1
+                self._records[hexsha] = record
+                return record
+            self.misses += 1
+        record = load(hexsha)
+        if self.size:
+            with self._lock:
+                self._records[hexsha] = record
+                while len(self._records) > self.size:
+                    self._records.popitem(last=False)
+        return record
+
+    def __str__(self):
+        return "%s, %s, %s" % (nItems(len(self), 'entry'),
+                                nItems(self.hits, 'hit'),
+                                nItems(self.misses, 'miss'))
+
+
+class _ShaIndex(object):
+    '''
+    Sorted list of all commit ids in a repository, resolving unique
+    prefixes without touching git. Recent misses are kept in a small
+    LRU cache, which is dropped whenever new commits are added.
+    '''
+    MAX_MISSES = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shas = []
+        self._misses = collections.OrderedDict()
+        self.tips = set()
+
+    def __len__(self):
+        return len(self._shas)
+
+    def add(self, shas, tips):
+        '''
+        Add list of commit ids. tips is the set of ref heads the index
+        now covers, used to find new commits next time.
+        '''
+        with self._lock:
+            new = [sha for sha in shas if not self._find(sha)]
+            if new:
+                self._shas.extend(new)
+                self._shas.sort()
+                self._misses.clear()
+            self.tips = tips
+
+    def _find(self, prefix):
+        ''' Return the unique commit id starting with prefix, or None. '''
+        i = bisect.bisect_left(self._shas, prefix)
+        if i == len(self._shas) or not self._shas[i].startswith(prefix):
+            return None
+        if i + 1 < len(self._shas) and self._shas[i + 1].startswith(prefix):
+            return None
+        return self._shas[i]
+
+    def lookup(self, prefix):
+        '''
+        Return the commit id with given prefix, or None if not found or
+        ambiguous.
+        '''
+        with self._lock:
+            if prefix in self._misses:
+                del self._misses[prefix]
+                self._misses[prefix] = True
+                return None
+            sha = self._find(prefix)
+            if not sha:
+                self._misses[prefix] = True
+                if len(self._misses) > self.MAX_MISSES:
+                    self._misses.popitem(last=False)
+            return sha
+
+
+class _CircuitBreaker(object):
+    """
+    Tracks failing fetches of a repository. After a failure the breaker
+    is open and fetches are suspended for a delay, starting at pollPeriod
+    and doubling for each consecutive failure up to maxBackoff. When the
+    delay has expired the breaker is half-open, allowing a trial fetch.
+    A successful fetch closes it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = None
+
+    @property
+    def state(self):
+        ''' Current state: CLOSED, OPEN or HALF_OPEN. '''
+        if not self.failures:
+            return self.CLOSED
+        if time.time() < self.retry_at:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        ''' Return True if a fetch should be attempted now. '''
+        return self.state != self.OPEN
+
+    def success(self):
+        ''' Record a successful fetch, close the breaker. '''
+        self.failures = 0
+        self.retry_at = 0
+        self.last_error = None
+
+    def failure(self, error):
+        ''' Record a failed fetch, open breaker. Returns retry delay. '''
+        self.failures += 1
+        self.last_error = str(error).strip().split('\n')[0]
+        base = config.global_option('pollPeriod').value or 60
+        delay = min(base * 2 ** (self.failures - 1),
+                    max(config.global_option('maxBackoff').value, base))
+        self.retry_at = time.time() + delay
+        return delay
+
+    def __str__(self):
+        if self.state == self.CLOSED:
+            return self.CLOSED
+        left = max(0, int(self.retry_at - time.time()))
+        return "%s after %s, next attempt in %d s (%s)" % (
+            self.state, nItems(self.failures, 'failure'), left,
+            self.last_error)
+
+
+class _PollTimer(object):
+    """
+    Decides when a repository is due for next fetch. The interval is the
+    period given to update(), unless adaptivePolling is set. It's then
+    halved after each fetch bringing new commits and grows by half after
+    each one which doesn't, within minPollPeriod and maxPollPeriod. The
+    interval is counted from the start of the fetch run, and next fetch
+    is moved earlier by a random part (pollJitter percent) of it,
+    spreading repositories over the scheduler ticks.
+    """
+    # Part of the interval a repository may be fetched early, so that a
+    # scheduler tick just before the due time doesn't miss it.
+    SLACK = 0.05
+
+    def __init__(self):
+        self.interval = None
+        self.next_at = 0
+
+    def due(self, now=None):
+        '''
+        Return True if the repository should be fetched at time now,
+        by default the current time.
+        '''
+        if now is None:
+            now = time.time()
+        return now >= self.next_at - self.SLACK * (self.interval or 0)
+
+    def update(self, period, active, start=None):
+        '''
+        Compute next fetch time after a fetch run started at start, by
+        default now. active is True if the fetch brought new commits.
+        '''
+        if not config.global_option('adaptivePolling').value:
+            self.interval = period
+        else:
+            low = config.global_option('minPollPeriod').value
+            high = max(config.global_option('maxPollPeriod').value, low)
+            interval = self.interval or period
+            interval = interval / 2.0 if active else interval * 1.5
+            self.interval = min(max(interval, low), high)
+        jitter = min(config.global_option('pollJitter').value, 100) / 100.0
+        if start is None:
+            start = time.time()
+        self.next_at = start + self.interval * (1 - jitter * random.random())
+
+    def __str__(self):
+        if self.interval is None:
+            return "not yet polled"
+        left = max(0, int(self.next_at - time.time()))
+        return "every %d s, next in %d s" % (self.interval, left)
 
 
 class _Repository(object):
@@ -196,6 +761,8 @@ class _Repository(object):
     Represents a git repository being monitored. The repository is a
     critical zone accessed both by main thread and the GitFetcher,
     guarded by the lock attribute.
+    commit_by_branch holds the hexsha of the last seen head of each
+    watched branch.
     """
 
     class Options(object):
@@ -218,9 +785,13 @@ class _Repository(object):
             self.snarf_msg = get_value('snarfMessage1')
             if get_value('snarfMessage2'):
                 self.snarf_msg += "\n" + get_value('snarfMessage2')
+            self.commit_template = _MessageTemplate(self.commit_msg)
+            self.snarf_template = _MessageTemplate(self.snarf_msg)
             self.group_header = get_value('groupHeader')
             self.enable_snarf = get_value('enableSnarf')
             self.timeout = get_value('fetchTimeout')
+            self.object_store = get_value('objectStore')
+            self.poll_period = get_value('pollPeriod')
 
     def __init__(self, reponame):
         """
@@ -231,8 +802,14 @@ class _Repository(object):
         self.options = self.Options(reponame)
         self.name = reponame
         self.commit_by_branch = {}
-        self.lock = threading.Lock()
+        self.lock = _TimedLock()
+        self.breaker = _CircuitBreaker()
+        self.poll_timer = _PollTimer()
+        self.warming = False
         self.repo = None
+        self.sha_index = _ShaIndex()
+        self.commit_cache = \
+            _CommitCache(config.global_option('commitCacheSize').value)
         self.path = os.path.join(self.options.repo_dir, self.name)
         if world.testing:
             self._clone()
@@ -240,6 +817,9 @@ class _Repository(object):
 
     branches = property(lambda self: self.commit_by_branch.keys())
 
+    poll_period = property(lambda self: self.options.poll_period or
+                               config.global_option('pollPeriod').value)
+
     @staticmethod
     def create(reponame, cloning_done_cb = lambda x: True, opts = None):
         '''
@@ -259,74 +839,421 @@ class _Repository(object):
             todo = lambda: cloning_done_cb(str(e))
         _Scheduler.run_callback(todo, 'clonecallback')
 
-    def _clone(self):
-        "Fix directories and run git-clone"
+    def _clone(self, timeout=0):
+        """
+        Fix directories and run git-clone. The clone is bare. If the
+        objectStore option is set it borrows objects from that shared
+        store. Otherwise, unless the url is a plain path, it's a partial
+        clone using the cloneFilter option. timeout applies to each git
+        operation, see _run_git.
+        """
         if not os.path.exists(self.options.repo_dir):
             os.makedirs(self.options.repo_dir)
         if os.path.exists(self.path):
             shutil.rmtree(self.path)
-        git.Git('.').clone(self.options.url, self.path, no_checkout=True)
+        args = ['clone', '--bare']
+        clone_filter = config.global_option('cloneFilter').value
+        url = self.options.url
+        store = self._get_store_path()
+        if store:
+            self._fill_store(store, timeout)
+            args += ['--reference=' + store, '--no-local']
+        elif clone_filter and (_url_host(url) or '://' in url):
+            # Plain paths are cloned locally, ignoring any filter.
+            args.append('--filter=' + clone_filter)
+        _run_git('.', args + [url, self.path], timeout = timeout)
+
+    def _get_store_path(self):
+        ''' Return absolute path to the shared object store, or None. '''
+        if not self.options.object_store:
+            return None
+        return os.path.abspath(os.path.join(self.options.repo_dir,
+                                            '.stores',
+                                            self.options.object_store))
+
+    def _store_refs(self):
+        ''' Return the ref namespace of this repository in the store. '''
+        return 'refs/repos/' + self.name
 
-    def init(self):
+    def _fill_store(self, store, timeout=0):
+        '''
+        Fetch the remote branches into the shared object store, creating
+        it if required. Only objects not already in the store, i. e. the
+        ones unique to this fork, are transferred. The branches are kept
+        below _store_refs(). Garbage collection is disabled in the store:
+        later fetches into the clones use all objects in the store, also
+        ones no ref in it keeps alive.
+        '''
+        if not os.path.exists(store):
+            try:
+                os.makedirs(store)
+            except OSError:
+                pass                    # Created by another clone.
+        url = self.options.url
+        if not _url_host(url) and '://' not in url:
+            url = os.path.abspath(url)          # git runs in the store.
+        _run_git(store, ['init', '--quiet', '--bare'])
+        for key, value in [('gc.auto', '0'), ('gc.pruneExpire', 'never')]:
+            _run_git(store, ['config', key, value])
+        _run_git(store, ['fetch', '--quiet', '--prune', url,
+                         '+refs/heads/*:%s/*' % self._store_refs()],
+                 timeout = timeout)
+
+    def remove(self):
+        '''
+        Delete the local clone, and this repository's refs in the shared
+        object store if any.
+        '''
+        store = self._get_store_path()
+        if store and os.path.exists(store):
+            refs = _run_git(store, ['for-each-ref', '--format=%(refname)',
+                                    self._store_refs()])
+            cmds = ['delete %s\n' % ref for ref in refs.split()]
+            if cmds:
+                _run_git(store, ['update-ref', '--stdin'], ''.join(cmds))
+        shutil.rmtree(self.path)
+
+    def _get_clone_url(self):
+        ''' Return the url of the existing clone, or None. '''
+        try:
+            return git.Repo(self.path).git.config('remote.origin.url')
+        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError,
+                git.GitCommandError):
+            return None
+
+    def warm_up(self, timeout=None, blocking=True):
+        '''
+        Initialize a repository in warming state, cloning it first if
+        the clone is missing or has another url. timeout applies to each
+        git operation contacting the remote, defaults to the fetchTimeout
+        option. Returns False without waiting if blocking is False and the
+        lock is busy, e. g. by another warm-up, else True. Errors are
+        propagated to caller.
+        '''
+        if timeout is None:
+            timeout = self.options.timeout
+        if not self.lock.acquire(blocking):
+            return False
+        try:
+            if not self.warming:
+                return True
+            url = self._get_clone_url()
+            if (not url or
+                    _normalize_url(url) != _normalize_url(self.options.url)):
+                self._clone(timeout)
+            self.init(timeout)
+            self.warming = False
+        finally:
+            self.lock.release()
+        return True
+
+    def restore(self, heads):
+        '''
+        Init from an existing clone and the saved heads dict (hexsha by
+        branch) without contacting the remote; changes made while not
+        running are found in next fetch. The commit id index is left to
+        update_index(). Returns False if not possible.
+        '''
+        try:
+            self.repo = git.Repo(self.path)
+            self.commit_by_branch = \
+                dict([(b, self.repo.commit(sha).hexsha)
+                          for b, sha in heads.items()])
+        except (git.exc.NoSuchPathError, git.exc.InvalidGitRepositoryError,
+                git.exc.BadObject, ValueError) as e:
+            self.log.info("Cannot restore %s: %s" % (self.name, str(e)))
+            self.commit_by_branch = {}
+            return False
+        return True
+
+    def init(self, timeout=None):
         ''' Lazy init invoked when a clone exists, reads repo data. '''
         self.repo = git.Repo(self.path)
         self.commit_by_branch = {}
-        for branch in _get_branches(self.options.branches, self.repo):
-            try:
-                if str(self.repo.active_branch) == branch:
-                    self.repo.remote().pull(branch)
-                else:
-                    self.repo.remote().fetch(branch + ':' + branch)
-                self.commit_by_branch[branch] = self.repo.commit(branch)
-            except git.GitCommandError as e:
-                self.log.error("Cannot checkout repo branch: " + branch)
-                raise e
+        if timeout is None:
+            timeout = self.options.timeout
+        self._fetch_remote(timeout)
+        remote_heads = self._get_heads(self._REMOTE_PREFIX)
+        branches = _get_branches(self.options.branches, remote_heads.keys())
+        try:
+            self._update_branches(branches)
+        except git.GitCommandError as e:
+            self.log.error("Cannot update repo branches: " + str(e))
+            raise e
+        for branch in branches:
+            self.commit_by_branch[branch] = remote_heads[branch]
+        self.update_index()
         return self
 
-    def fetch(self):
-        "Contact git repository and update branches appropriately."
-        self.repo.remote().update()
-        for branch in self.branches:
-            try:
-                timer = threading.Timer(self.options.timeout, lambda: [][5])
-                timer.start()
-                if str(self.repo.active_branch) == branch:
-                    self.repo.remote().pull(branch)
-                else:
-                    self.repo.remote().fetch(branch + ':' + branch)
-                timer.cancel()
-            except IndexError:
-                self.log.error('Timeout in fetch() for %s at %s' %
-                                   (branch, self.name))
-            except (OSError, git.GitCommandError) as e:
-                self.log.error("Problem accessing local repo: " +
-                               str(e))
+    _REMOTE_PREFIX = 'refs/remotes/origin'
+    _LOCAL_PREFIX = 'refs/heads'
+    FETCH_ARGS = ['fetch', 'origin', '+refs/heads/*:%s/*' % _REMOTE_PREFIX]
+    LS_REMOTE_ARGS = ['ls-remote', '--heads', 'origin']
+
+    def _get_heads(self, prefix):
+        ''' Return dict of hexsha by branch for refs below prefix. '''
+        out = self.repo.git.for_each_ref(prefix,
+                                         format='%(objectname) %(refname)')
+        heads = {}
+        for line in out.splitlines():
+            sha, ref = line.split(' ', 1)
+            branch = ref[len(prefix) + 1:]
+            if branch != 'HEAD':
+                heads[branch] = sha
+        return heads
+
+    def _fetch_remote(self, timeout):
+        ''' Fetch all remote branches to remote-tracking refs. '''
+        _run_git(self.path, self.FETCH_ARGS, timeout = timeout)
+
+    def _update_branches(self, branches):
+        '''
+        Set local branches to their remote-tracking ref in one local
+        transaction. Returns list of branches which were updated.
+        '''
+        remote = self._get_heads(self._REMOTE_PREFIX)
+        local = self._get_heads(self._LOCAL_PREFIX)
+        updated = [b for b in branches
+                       if b in remote and remote[b] != local.get(b)]
+        if updated:
+            cmds = ['update %s/%s %s\n' % (self._LOCAL_PREFIX, b, remote[b])
+                        for b in updated]
+            _run_git(self.path, ['update-ref', '--stdin'], ''.join(cmds))
+        for branch in updated:
+            self.log.debug("Fetch: %s at %s: %s -> %s" %
+                           (branch, self.name,
+                            local.get(branch, '(none)')[:7],
+                            remote[branch][:7]))
+        return updated
+
+    def ls_remote(self, timeout=None):
+        '''
+        Return dict of hexsha by branch for the remote branches, using
+        git ls-remote. timeout defaults to the fetchTimeout option.
+        '''
+        if timeout is None:
+            timeout = self.options.timeout
+        return self.parse_ls_remote(
+            _run_git(self.path, self.LS_REMOTE_ARGS, timeout = timeout))
+
+    @classmethod
+    def parse_ls_remote(cls, out):
+        ''' Return dict of hexsha by branch from git ls-remote output. '''
+        heads = {}
+        for line in out.splitlines():
+            sha, ref = line.split('\t', 1)
+            heads[ref[len(cls._LOCAL_PREFIX) + 1:]] = sha
+        return heads
+
+    def get_moved(self, remote_heads):
+        '''
+        Return list of watched branches whose head in the remote_heads
+        dict (as from ls_remote) differs from the local one.
+        '''
+        local = self._get_heads(self._LOCAL_PREFIX)
+        return [b for b, sha in remote_heads.iteritems()
+                    if b in self.commit_by_branch and local.get(b) != sha]
+
+    def probe(self, timeout=None):
+        '''
+        Cheap check for remote changes using git ls-remote. Returns list of
+        watched branches whose remote head differs from the local one.
+        timeout defaults to the fetchTimeout option.
+        '''
+        return self.get_moved(self.ls_remote(timeout))
+
+    def fetch(self, timeout=None):
+        '''
+        Contact git repository and update branches appropriately. All
+        branches are fetched in a single git fetch. Returns list of
+        watched branches which were updated. timeout defaults to the
+        fetchTimeout option, GitTimeoutError is raised if it expires.
+        '''
+        if timeout is None:
+            timeout = self.options.timeout
+        self._fetch_remote(timeout)
+        return self.fetch_done()
+
+    def fetch_done(self):
+        '''
+        Update branches and index after the remote-tracking branches have
+        been fetched, see FETCH_ARGS. Returns list of updated branches.
+        '''
+        updated = self._update_branches(self.branches)
+        self.update_index()
+        return updated
+
+    def _get_clone_filter(self):
+        ''' Return the partial clone filter of the clone, or None. '''
+        try:
+            return self.repo.git.config('remote.origin.partialclonefilter')
+        except git.GitCommandError:
+            return None
+
+    # Remote set to the clone fetch_from() fetches from. A partial clone
+    # records filtered fetches in the remote's config, so it must be named.
+    _DEDUP_REMOTE = 'dedup'
+
+    def fetch_from(self, repository):
+        '''
+        Like fetch(), but fetch the remote-tracking branches of another
+        repository with the same url instead of contacting the remote.
+        '''
+        refs = '+%s/*:%s/*' % (self._REMOTE_PREFIX, self._REMOTE_PREFIX)
+        self.repo.git.config('remote.%s.url' % self._DEDUP_REMOTE,
+                             os.path.abspath(repository.path))
+        args = ['fetch', self._DEDUP_REMOTE, refs]
+        clone_filter = self._get_clone_filter()
+        if clone_filter:
+            # Don't make the other clone fetch objects we don't want.
+            args[1:1] = ['--filter=' + clone_filter,
+                         '--upload-pack=git -c uploadpack.allowFilter=true'
+                         ' upload-pack']
+        _run_git(self.path, args)
+        return self.fetch_done()
+
+    def update_index(self):
+        '''
+        Add commits not reachable from the last indexed refs. Indexes all
+        commits the first time.
+        '''
+        tips = set(self.repo.git.for_each_ref(
+                                    format='%(objectname)').split())
+        if tips == self.sha_index.tips:
+            return
+        exclude = ['^' + sha for sha in self.sha_index.tips]
+        try:
+            shas = self.repo.git.rev_list('--all', *exclude).split()
+        except git.GitCommandError:
+            # Some old tip is gone (pruned), index everything again.
+            shas = self.repo.git.rev_list('--all').split()
+        self.sha_index.add(shas, tips)
+
+    def _load_commit(self, sha):
+        ''' Read a _CommitRecord from the object database. '''
+        return _CommitRecord(self.repo.commit(sha))
 
     def get_commit(self, sha):
-        "Fetch the commit with the given SHA, throws BadObject."
-        return self.repo.commit(sha)
+        '''
+        Return the _CommitRecord for a SHA or other revision like a
+        branch name, throws BadObject.
+        '''
+        if len(sha) != 40:
+            sha = self.repo.commit(sha).hexsha
+        return self.commit_cache.get(sha, self._load_commit)
+
+    def get_stats(self, sha):
+        ''' Return the diffstat totals dict for commit with given SHA. '''
+        return self.repo.commit(sha).stats.total
+
+    def _merge_base(self, old, new):
+        """
+        Return the merge base of two commits (hexsha), or None if they
+        have no common history. git merge-base only walks back until the
+        histories meet.
+        """
+        try:
+            return self.repo.git.merge_base(old, new)
+        except git.GitCommandError:
+            return None
 
     def get_new_commits(self):
         '''
         Return dict of commits by branch which are more recent then those
-        in self.commit_by_branch
+        in self.commit_by_branch. Only the newest maxCommitsAtOnce commits
+        are read for each branch, the total attribute of each returned
+        _CommitList holds the size of the complete range.
         '''
+        limit = config.global_option('maxCommitsAtOnce').value
+        kwargs = {'max_count': limit} if limit else {}
         new_commits_by_branch = {}
-        for branch in self.commit_by_branch:
-            rev = "%s..%s" % (self.commit_by_branch[branch], branch)
-            # Workaround for GitPython bug:
-            # https://github.com/gitpython-developers/GitPython/issues/61
-            self.repo.odb.update_cache()
-            results = list(self.repo.iter_commits(rev))
-            new_commits_by_branch[branch] = results
+        # Workaround for GitPython bug:
+        # https://github.com/gitpython-developers/GitPython/issues/61
+        self.repo.odb.update_cache()
+        heads = self._get_heads(self._LOCAL_PREFIX)
+        for branch, last in self.commit_by_branch.iteritems():
+            head = heads.get(branch, last)
+            if head == last:
+                new_commits_by_branch[branch] = _CommitList([], head=head)
+                continue
+            base = self._merge_base(last, head)
+            if base != last:
+                self.log.info("Forced update of %s at %s (%s -> %s)" %
+                              (branch, self.name, last[:7], head[:7]))
+            rev = "%s..%s" % (base, branch) if base else branch
+            shas = self.repo.git.rev_list(rev, **kwargs).split()
+            results = [self.get_commit(sha) for sha in shas]
+            total = len(results)
+            if base and limit and total == limit:
+                total = int(self.repo.git.rev_list(rev, count=True))
+            new_commits_by_branch[branch] = \
+                _CommitList(results, total, head)
             self.log.debug("Poll: branch: %s last commit: %s, %d commits" %
-                           (branch, str(self.commit_by_branch[branch])[:7],
-                                        len(results)))
+                           (branch, last[:7], total))
         return new_commits_by_branch
 
     def get_recent_commits(self, branch, count):
-        ''' Return count top commits for a branch in a repo. '''
-        return list(self.repo.iter_commits(branch))[:count]
+        '''
+        Return count top commits for a branch in a repo. The history walk
+        (git rev-list) stops after count commits.
+        '''
+        shas = self.repo.git.rev_list(branch, max_count=count).split()
+        return [self.get_commit(sha) for sha in shas]
+
+
+class _HeadStore(object):
+    '''
+    The last seen branch heads by repository, persisted in a json file
+    in repoDir. Each entry also holds the url and branches option it was
+    created with; it's not used if these have changed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.log = log.getPluginLogger('git.heads')
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._data = json.load(f)
+        except IOError:
+            self._data = {}
+        except ValueError:
+            self.log.warning("Ignoring unreadable heads file " + path)
+            self._data = {}
+
+    def get(self, repository):
+        ''' Return dict of hexsha by branch for repository or None. '''
+        with self._lock:
+            entry = self._data.get(repository.name)
+        if (not entry or
+                entry['url'] != repository.options.url or
+                entry['branches'] != repository.options.branches):
+            return None
+        return entry['heads']
+
+    def update(self, repositories):
+        '''
+        Store the heads of repositories, dropping entries for all other
+        repositories. Write to disk if anything has changed.
+        '''
+        data = {}
+        for repository in repositories:
+            data[repository.name] = {
+                'url': repository.options.url,
+                'branches': repository.options.branches,
+                'heads': dict(repository.commit_by_branch)
+            }
+        with self._lock:
+            if data == self._data:
+                return
+            self._data = data
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f, indent=1, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                self.log.error("Cannot save heads: " + str(e))
 
 
 class _Repos(object):
@@ -338,8 +1265,114 @@ class _Repos(object):
     def __init__(self):
         self._lock = threading.Lock()
         self._list = []
+        repo_dir = config.global_option('repoDir').value
+        if not os.path.exists(repo_dir):
+            os.makedirs(repo_dir)
+        self._heads = _HeadStore(os.path.join(repo_dir, '.heads.json'))
+        repositories = []
         for repo in config.global_option('repolist').value:
-            self.append(_Repository(repo).init())
+            repository = _Repository(repo)
+            heads = self._heads.get(repository)
+            if not heads or not repository.restore(heads):
+                if world.testing:
+                    repository.init()
+                else:
+                    repository.warming = True
+            repositories.append(repository)
+        self.set(repositories)
+        self._warm_up([r for r in repositories if r.warming])
+        self._build_indexes([r for r in repositories if not r.warming])
+
+    @staticmethod
+    def _build_indexes(repositories):
+        '''
+        Build the commit id index of restored repositories in a background
+        thread. Until done, their commit ids are not snarfed.
+        '''
+        log_ = log.getPluginLogger('git.index')
+
+        def work():
+            ''' Thread body: index the repositories. '''
+            for repository in repositories:
+                try:
+                    repository.update_index()
+                except (OSError, git.GitCommandError) as e:
+                    log_.error("Cannot index %s: %s" %
+                               (repository.name, str(e)))
+
+        if world.testing:
+            work()
+            return
+        thread = threading.Thread(target = work)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _warm_up(self, repositories):
+        '''
+        Initialize repositories in fetchWorkers background threads.
+        Failures are handled by the fetcher, which retries the init.
+        '''
+        log_ = log.getPluginLogger('git.warmup')
+        pending = list(repositories)
+        lock = threading.Lock()
+
+        def work():
+            ''' Thread body: warm up repositories until none is left. '''
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    repository = pending.pop(0)
+                try:
+                    repository.warm_up()
+                    self.save_heads()
+                    log_.info("Repository %s is ready." % repository.name)
+                except (OSError, GitPluginException, git.GitCommandError,
+                        git.exc.InvalidGitRepositoryError) as e:
+                    repository.breaker.failure(e)
+                    log_.error("Cannot initialize %s: %s" %
+                               (repository.name, str(e)))
+
+        count = min(config.global_option('fetchWorkers').value, len(pending))
+        for i in range(count):
+            thread = threading.Thread(target = work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def reload(self):
+        '''
+        Apply changed registry settings. Repositories whose url or branches
+        have changed are replaced by new instances, initialized in the
+        background. Other options are updated in place. Returns list of
+        the replaced and added repositories.
+        '''
+        with self._lock:
+            live = dict([(r.name, r) for r in self._list])
+        repositories = []
+        restarted = []
+        for name in config.global_option('repolist').value:
+            old = live.get(name)
+            if old:
+                options = _Repository.Options(name)
+                if (options.url == old.options.url and
+                        options.branches == old.options.branches):
+                    old.options = options
+                    repositories.append(old)
+                    continue
+            repository = _Repository(name)
+            if old:
+                # Serialize with any fetch running on the old instance.
+                repository.lock = old.lock
+            repository.warming = not world.testing
+            repositories.append(repository)
+            restarted.append(repository)
+        self.set(repositories)
+        self._warm_up([r for r in restarted if r.warming])
+        return restarted
+
+    def save_heads(self):
+        ''' Persist the current branch heads of all repositories. '''
+        self._heads.update(self.get())
 
     def set(self, repositories):
         ''' Update the repository list. '''
@@ -347,6 +1380,7 @@ class _Repos(object):
             self._list = repositories
             repolist = [r.name for r in repositories]
             config.global_option('repolist').setValue(repolist)
+        self.save_heads()
 
     def append(self, repository):
         ''' Add new repository to shared list. '''
@@ -354,6 +1388,7 @@ class _Repos(object):
             self._list.append(repository)
             repolist = [r.name for r in self._list]
             config.global_option('repolist').setValue(repolist)
+        self.save_heads()
 
     def remove(self, repository):
         ''' Remove repository from list. '''
@@ -362,6 +1397,7 @@ class _Repos(object):
             repolist = [r.name for r in self._list]
             config.global_option('repolist').setValue(repolist)
             config.unregister_repo(repository.name)
+        self.save_heads()
 
     def get(self):
         ''' Return copy of the repository list. '''
@@ -372,41 +1408,502 @@ class _Repos(object):
 class _GitFetcher(threading.Thread):
     """
     Thread replicating remote data to local repos roughly using git pull and
-    git fetch. When done schedules a callback call and exits.
+    git fetch. The repositories are fetched concurrently by a pool of
+    fetchWorkers threads, running at most fetchesPerHost fetches against
+    the same remote host. Repositories with the same (normalized) url are
+    fetched as a group: the first one from the remote, the others from its
+    clone. The git processes are killed if they exceed the repository's
+    fetchTimeout, or if the whole run exceeds the global fetchTimeout.
+    Repositories not started by then are skipped until next run.
+    Each fetched repository is then polled for new commits. When done
+    schedules a callback call with the resulting notifications and exits.
+    If targets is given only these repositories are fetched, right away
+    and without probing.
     """
 
-    def __init__(self, repos, fetch_done_cb):
+    def __init__(self, repos, fetch_done_cb, targets=None):
         self.log = log.getPluginLogger('git.fetcher')
         threading.Thread.__init__(self)
         self._shutdown = False
         self._repos = repos
+        self._targets = targets
         self._callback = fetch_done_cb
+        self._cond = threading.Condition()
+        self._pending = []
+        self._busy_by_host = {}
+        self._deadline = None
+        self._started = None
+        self._notifications = []
 
     def stop(self):
         """
         Shut down the thread as soon as possible. May take some time if
         inside a long-running fetch operation.
         """
-        self._shutdown = True
+        with self._cond:
+            self._shutdown = True
+            self._cond.notifyAll()
+
+    def _next_group(self):
+        '''
+        Return next pending group of repositories whose host has a free
+        fetch slot, waiting for one if required. Returns None when all is
+        done.
+        '''
+        with self._cond:
+            while not self._shutdown and self._pending:
+                group = self._take_group()
+                if group:
+                    return group
+                self._cond.wait()
+            return None
+
+    def _take_group(self):
+        '''
+        Return next pending group whose host has a free fetch slot, or
+        None. Caller must hold self._cond.
+        '''
+        per_host = config.global_option('fetchesPerHost').value
+        for group in self._pending:
+            host = _url_host(group[0].options.url)
+            busy = self._busy_by_host.get(host, 0)
+            if not host or not per_host or busy < per_host:
+                self._pending.remove(group)
+                self._busy_by_host[host] = busy + 1
+                return group
+        return None
+
+    def _release(self, group):
+        ''' Return the host fetch slot used by group. '''
+        with self._cond:
+            self._busy_by_host[_url_host(group[0].options.url)] -= 1
+            self._cond.notifyAll()
+
+    def _get_timeout(self, repository):
+        '''
+        Return timeout for next git operation on repository, bounded by
+        the time left in this run. Raises GitFetchSkipped if none is left.
+        '''
+        timeout = repository.options.timeout
+        if not self._deadline:
+            return timeout
+        left = self._deadline - time.time()
+        if left <= 0:
+            raise GitFetchSkipped("Fetch run out of time, skipping " +
+                                  repository.name)
+        return min(timeout, left) if timeout > 0 else left
+
+    def _fetch(self, group, probe):
+        '''
+        Fetch first repository in group if probe is False or finds remote
+        changes for any repository in group. Repositories still warming up
+        are initialized instead, unless their warm-up is in progress.
+        Returns list of updated branches, None if not fetched.
+        '''
+        repository = group[0]
+        if repository.warming:
+            if not repository.warm_up(self._get_timeout(repository),
+                                      blocking = False):
+                raise GitFetchSkipped("Warm-up of %s in progress, skipping" %
+                                      repository.name)
+            return None
+        with repository.lock:
+            if probe:
+                heads = repository.ls_remote(self._get_timeout(repository))
+                if not [r for r in group if r.get_moved(heads)]:
+                    self.log.debug("No remote changes in " + repository.name)
+                    return None
+            return repository.fetch(self._get_timeout(repository))
+
+    def _fetch_from(self, repository, source):
+        '''
+        Fetch repository from the clone of source, same url. Returns list
+        of updated branches.
+        '''
+        self.log.debug("Fetching %s from %s" % (repository.name, source.name))
+        try:
+            with repository.lock:
+                updated = repository.fetch_from(source)
+        except (OSError, git.GitCommandError) as e:
+            self._failed(repository, e)
+            return []
+        self._succeeded(repository)
+        return updated
+
+    def _skip(self, group, reason):
+        '''
+        Give up fetching group in this run, without counting it as a
+        failure. The poll timers are left as is, so it's fetched in next
+        run.
+        '''
+        self._release(group)
+        self.log.info(str(reason))
+
+    def _succeeded(self, repository):
+        ''' Record a successful fetch. '''
+        repository.breaker.success()
+
+    def _failed(self, repository, error):
+        ''' Record a failed fetch, log a traceback only on first one. '''
+        delay = repository.breaker.failure(error)
+        if repository.breaker.failures == 1:
+            self.log.error("Cannot fetch %s: %s" % (repository.name, error),
+                           exc_info=True)
+        else:
+            self.log.warning("Cannot fetch %s (%s), next attempt in %d s" %
+                             (repository.name,
+                              nItems(repository.breaker.failures, 'failure'),
+                              delay))
+
+    def _record(self, group, updated, error):
+        '''
+        Record the outcome of fetching the first repository in group:
+        error if it failed, else list of updated branches (None if not
+        fetched). The other repositories then fetch from it if required.
+        Returns set of repositories with new commits.
+        '''
+        active = set()
+        if error:
+            for repository in group:
+                self._failed(repository, error)
+            return active
+        self._succeeded(group[0])
+        if updated:
+            active.add(group[0])
+        for repository in group[1:]:
+            if updated is None:
+                self._succeeded(repository)
+            elif self._fetch_from(repository, group[0]):
+                active.add(repository)
+        return active
+
+    def _done(self, group, updated, error=None):
+        '''
+        Finish fetching group (see _record), release its host slot and
+        poll it for new commits.
+        '''
+        try:
+            active = self._record(group, updated, error)
+        finally:
+            self._release(group)
+        for repository in group:
+            repository.poll_timer.update(repository.poll_period,
+                                         repository in active,
+                                         self._started)
+        notifications = _poll_all_repos(group)
+        with self._cond:
+            self._notifications.extend(notifications)
+
+    def _fetch_group(self, group, probe):
+        ''' Fetch a group of repositories and poll them. '''
+        try:
+            updated = self._fetch(group, probe)
+        except GitFetchSkipped as e:
+            self._skip(group, e)
+        except (GitTimeoutError, OSError, git.GitCommandError,
+                git.exc.InvalidGitRepositoryError) as e:
+            self._done(group, None, e)
+        except Exception:
+            self._release(group)
+            raise
+        else:
+            self._done(group, updated)
+
+    def _use_probe(self):
+        ''' Return True if remotes should be probed before fetching. '''
+        return config.global_option('probeBeforeFetch').value \
+            and not self._targets
+
+    def _work(self):
+        ''' Worker thread: fetch repositories until none is left. '''
+        probe = self._use_probe()
+        while True:
+            group = self._next_group()
+            if not group:
+                return
+            self._fetch_group(group, probe)
+
+    def _drive(self):
+        ''' Fetch the pending groups using fetchWorkers threads. '''
+        count = min(config.global_option('fetchWorkers').value,
+                    len(self._pending))
+        workers = [threading.Thread(target = self._work)
+                       for i in range(count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
 
     def run(self):
         start = time.time()
-        for repository in self._repos.get():
-            if self._shutdown:
-                break
-            try:
-                with repository.lock:
-                    repository.fetch()
-            except git.GitCommandError as e:
-                self.log.error("Error in git command: " + str(e),
-                                   exc_info=True)
-        _Scheduler.run_callback(self._callback, 'fetch_callback')
+        self._started = start
+        timeout = config.global_option('fetchTimeout').value
+        self._deadline = start + timeout if timeout else None
+        self._pending = []
+        groups = {}
+        for repository in self._targets or self._repos.get():
+            if not repository.breaker.allow():
+                self.log.debug("Skipping %s: %s" %
+                               (repository.name, repository.breaker))
+            elif not self._targets and not repository.poll_timer.due(start):
+                continue
+            elif repository.warming:
+                self._pending.append([repository])
+            else:
+                url = _normalize_url(repository.options.url)
+                if url in groups:
+                    groups[url].append(repository)
+                else:
+                    groups[url] = [repository]
+                    self._pending.append(groups[url])
+        try:
+            self._drive()
+        finally:
+            self._repos.save_heads()
+            notifications = self._notifications
+            # Unique id: a pending callback holds the only copy of its
+            # notifications and must not be replaced by another fetcher's.
+            _Scheduler.run_callback(lambda: self._callback(notifications),
+                                    'fetch_callback.%x' % id(self))
         self.log.debug("Exiting fetcher thread, elapsed: " +
                        str(time.time() - start))
 
 
+class _EventFetcher(_GitFetcher):
+    """
+    A _GitFetcher running the remote git operations (ls-remote probes and
+    fetches) as concurrent processes in a single thread, waiting for their
+    output with poll() instead of using a thread per fetch. At most
+    fetchWorkers processes run at the same time, subject to fetchesPerHost.
+    The repository lock is held while fetching; if it's busy the fetch
+    waits until it's free or the run is out of time.
+    The local git operations after each fetch and the polls are run in the
+    same thread. Repositories still warming up are cloned and initialized
+    in helper threads.
+    """
+
+    def __init__(self, repos, fetch_done_cb, targets=None):
+        _GitFetcher.__init__(self, repos, fetch_done_cb, targets)
+        self._running = {}
+        self._locked = []
+        self._helpers = []
+
+    PROBE = 'probe'
+    FETCH = 'fetch'
+
+    def _start(self, group, stage):
+        ''' Start the git process for a stage of fetching group. '''
+        repository = group[0]
+        try:
+            timeout = self._get_timeout(repository)
+        except GitFetchSkipped as e:
+            self._skip(group, e)
+            return
+        if stage == self.PROBE:
+            args = repository.LS_REMOTE_ARGS
+        elif repository.lock.acquire(False):
+            args = repository.FETCH_ARGS
+        else:
+            self._locked.append(group)      # Retried by _wait().
+            return
+        try:
+            process = _GitProcess(repository.path, args, timeout)
+        except OSError as e:
+            if stage == self.FETCH:
+                repository.lock.release()
+            self._done(group, None, e)
+            return
+        self._running[process] = (group, stage)
+
+    def _start_ready(self, probe):
+        ''' Start fetching pending groups while there are free slots. '''
+        limit = config.global_option('fetchWorkers').value
+        while True:
+            self._helpers = [h for h in self._helpers if h.is_alive()]
+            busy = len(self._running) + len(self._locked) + len(self._helpers)
+            if busy >= limit:
+                return
+            with self._cond:
+                group = self._take_group()
+            if not group:
+                return
+            if group[0].warming:
+                helper = threading.Thread(target = self._fetch_group,
+                                          args = (group, False))
+                helper.start()
+                self._helpers.append(helper)
+            else:
+                self._start(group, self.PROBE if probe else self.FETCH)
+
+    def _step(self, process, group, stage):
+        '''
+        Handle a completed git process: start the fetch after a probe
+        finding changes, otherwise finish fetching the group.
+        '''
+        repository = group[0]
+        try:
+            try:
+                out = process.result()
+                if stage == self.PROBE:
+                    heads = repository.parse_ls_remote(out)
+                    if [r for r in group if r.get_moved(heads)]:
+                        self._start(group, self.FETCH)
+                        return
+                    self.log.debug("No remote changes in " + repository.name)
+                    updated = None
+                else:
+                    updated = repository.fetch_done()
+            finally:
+                if stage == self.FETCH:
+                    repository.lock.release()
+        except (GitTimeoutError, OSError, git.GitCommandError,
+                git.exc.InvalidGitRepositoryError) as e:
+            self._done(group, None, e)
+        else:
+            self._done(group, updated)
+
+    def _wait(self):
+        '''
+        Wait until some output is available or a deadline passes, then
+        read it and handle completed or timed out processes.
+        '''
+        fds = {}
+        poller = select.poll()
+        for process in self._running:
+            for fd in process.fds():
+                fds[fd] = process
+                poller.register(fd, select.POLLIN)
+        deadlines = [p.deadline for p in self._running if p.deadline]
+        wait = min([1.0] + [max(0, d - time.time()) for d in deadlines])
+        if self._locked:
+            wait = min(wait, 0.1)
+        ready = []
+        if fds:
+            try:
+                ready = [fd for fd, event in poller.poll(int(1000 * wait))]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        else:
+            time.sleep(min(wait, 0.1))
+        for fd in ready:
+            fds[fd].read(fd)
+        now = time.time()
+        for process, (group, stage) in self._running.items():
+            process.check_timeout(now)
+            if process.done:
+                del self._running[process]
+                self._step(process, group, stage)
+        locked = self._locked
+        self._locked = []
+        for group in locked:
+            self._start(group, self.FETCH)
+
+    def _drive(self):
+        ''' Fetch the pending groups, see class docstring. '''
+        probe = self._use_probe()
+        try:
+            while not self._shutdown:
+                self._start_ready(probe)
+                if (not self._running and not self._pending and
+                        not self._locked):
+                    break
+                self._wait()
+        finally:
+            for process, (group, stage) in self._running.items():
+                process.kill()
+                process.wait()
+                if stage == self.FETCH:
+                    group[0].lock.release()
+            for helper in self._helpers:
+                helper.join()
+
+
+class _NotifyServer(threading.Thread):
+    """
+    Optional HTTP listener for push notifications from e. g., a git
+    post-receive hook or a forge webhook. A POST to /<repository name>,
+    or to / with a webhook json payload holding the repository url, makes
+    the scheduler fetch and poll the repository right away. If the body
+    lists the moved refs, as post-receive input or the json 'ref' value,
+    notifications for unwatched branches are ignored.
+    """
+
+    def __init__(self, repos, scheduler):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.log = log.getPluginLogger('git.notify')
+        self._repos = repos
+        self._scheduler = scheduler
+        address = (config.global_option('notifyAddress').value,
+                   config.global_option('notifyPort').value)
+        self.server = BaseHTTPServer.HTTPServer(address, self._get_handler())
+
+    def _get_handler(self):
+        ''' Return the request handler class, bound to this server. '''
+        notifier = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            ''' Handle POSTed notifications, reply with names fetched. '''
+            # pylint: disable=C0103
+
+            def do_POST(self):
+                ''' Handle a notification. '''
+                length = int(self.headers.getheader('content-length') or 0)
+                names = notifier.notify(self.path, self.rfile.read(length))
+                self.send_response(202 if names else 404)
+                self.send_header('Content-Type', 'text/plain')
+                self.end_headers()
+                self.wfile.write(''.join([n + '\n' for n in names]))
+
+            def log_message(self, fmt, *args):
+                notifier.log.debug(fmt % args)
+
+        return Handler
+
+    def notify(self, path, body):
+        '''
+        Schedule fetching of the repositories matching a notification.
+        Returns list of names of these repositories.
+        '''
+        name = urllib.unquote(path.split('?', 1)[0].strip('/'))
+        urls, refs = _parse_notification(body)
+        moved = set([r[len('refs/heads/'):] for r in refs
+                        if r.startswith('refs/heads/')])
+        names = []
+        for repository in self._repos.get():
+            if name:
+                matches = repository.name == name
+            else:
+                matches = _normalize_url(repository.options.url) in urls
+            if not matches or repository.warming:
+                continue
+            if refs and not moved & set(repository.branches):
+                self.log.debug("Ignoring %s: no watched branch in %s" %
+                               (repository.name, ', '.join(refs)))
+                continue
+            self.log.debug("Notified: " + repository.name)
+            _Scheduler.run_callback(
+                lambda r=repository: self._scheduler.fetch_now(r),
+                'notify.' + repository.name)
+            names.append(repository.name)
+        return names
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        ''' Stop serving and close the listening socket. '''
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class _DisplayCtx(object):
-    ''' Simple container for displaying commits stuff. '''
+    '''
+    Simple container for displaying commits stuff. The rendered lines
+    don't depend on irc and channel, which are only used when the lines
+    are turned into messages.
+    '''
     SNARF = 'snarf'
     REPOLOG = 'repolog'
     COMMITS = 'commits'
@@ -416,53 +1913,85 @@ class _DisplayCtx(object):
         self.channel = channel
         self.repo = repository
         self.kind = kind if kind else self.COMMITS
+        self._lines = []
 
     _use_group_header = property(lambda self:
         self.repo.options.group_header and self.kind != self.REPOLOG)
 
+    def _add(self, line):
+        ''' Add a line to the rendered output. '''
+        self._lines.append(line)
+
     def _display_some_commits(self, commits, branch):
         "Display a nicely-formatted list of commits for an author/branch."
         for commit in commits:
-            lines = _format_message(self, commit, branch)
-            for line in lines:
-                msg = ircmsgs.privmsg(self.channel, line)
-                self.irc.queueMsg(msg)
+            for line in _format_message(self, commit, branch):
+                self._add(line)
 
     def _get_limited_commits(self, commits_by_branch):
-        "Return the topmost commits which are OK to display."
-        top_commits = []
+        '''
+        Return set of hexsha for the topmost commits which are OK to
+        display. Ties are resolved in favor of commits seen last.
+        '''
+        all_commits = []
+        total = 0
         for commits in commits_by_branch.values():
-            top_commits.extend(commits)
-        top_commits = sorted(top_commits, key = lambda c: c.committed_date)
+            all_commits.extend(commits)
+            total += getattr(commits, 'total', len(commits))
         commits_at_once = config.global_option('maxCommitsAtOnce').value
-        if len(top_commits) > commits_at_once:
-            self.irc.queueMsg(ircmsgs.privmsg(self.channel,
-                             "Showing latest %d of %d commits to %s..." % (
-                             commits_at_once,
-                             len(top_commits),
-                             self.repo.name,
-                             )))
-        top_commits = top_commits[-commits_at_once:]
-        return top_commits
+        if total > commits_at_once:
+            self._add("Showing latest %d of %d commits to %s..." % (
+                      commits_at_once,
+                      total,
+                      self.repo.name,
+                      ))
+        if commits_at_once:
+            keyed = heapq.nlargest(commits_at_once,
+                                   enumerate(all_commits),
+                                   key=lambda ic: (ic[1].committed_date,
+                                                   ic[0]))
+            all_commits = [c for i, c in keyed]
+        return set([c.hexsha for c in all_commits])
 
     @property
     def format(self):
-        ''' Return actual format line to use. '''
+        ''' Return compiled message template to use. '''
         if self.kind == self.SNARF:
-            return self.repo.options.snarf_msg
+            return self.repo.options.snarf_template
         else:
-            return self.repo.options.commit_msg
+            return self.repo.options.commit_template
 
     def display_commits(self, commits_by_branch):
         "Display a nicely-formatted list of commits in a channel."
+        for msg in self.get_messages(commits_by_branch):
+            self.irc.queueMsg(msg)
+
+    def get_messages(self, commits_by_branch):
+        '''
+        Return a nicely-formatted list of commits as a list of messages
+        to the channel, without sending them.
+        '''
+        return [ircmsgs.privmsg(self.channel, line)
+                    for line in self.get_lines(commits_by_branch)]
 
+    def get_lines(self, commits_by_branch):
+        '''
+        Return a nicely-formatted list of commits as a list of text
+        lines, the same for all channels.
+        '''
+        self._lines = []
         if not commits_by_branch:
-            return
+            return self._lines
         top_commits = self._get_limited_commits(commits_by_branch)
         for branch, all_commits in commits_by_branch.iteritems():
-            for a in set([c.author.name for c in all_commits]):
-                commits = [c for c in all_commits
-                               if c.author.name == a and c in top_commits]
+            commits_by_author = {}
+            for c in all_commits:
+                if c.hexsha in top_commits:
+                    commits_by_author.setdefault(c.author_name, []).append(c)
+            for a in set([c.author_name for c in all_commits]):
+                commits = commits_by_author.get(a)
+                if not commits:
+                    continue
                 if not self._use_group_header:
                     self._display_some_commits(commits, branch)
                     continue
@@ -472,9 +2001,9 @@ class _DisplayCtx(object):
                     name = self.repo.name
                     line = "%s pushed %d commit(s) to %s at %s" % (
                         a, len(commits), branch, name)
-                msg = ircmsgs.privmsg(self.channel, line)
-                self.irc.queueMsg(msg)
+                self._add(line)
                 self._display_some_commits(commits, branch)
+        return self._lines
 
 
 class _Scheduler(object):
@@ -483,19 +2012,25 @@ class _Scheduler(object):
 
     Polling happens in three steps:
      -  reset()  kills all active jobs  and schedules
-        start_fetch to be invoked periodically.
+        start_fetch to be invoked periodically, TICKS_PER_PERIOD times
+        per shortest configured poll period.
      -  start_fetch() fires off the one-shot GitFetcher
-        thread which handles the long-running git replication.
-     -  When done, the GitFetcher thread invokes Scheduler.run_callback.
-        This invokes poll_all_repos in main thread but this is quick,
-        (almost) no remote IO is needed.
+        thread which handles the long-running git replication of
+        the repositories due to be fetched, see _PollTimer.
+     -  The GitFetcher thread also polls the repositories for new
+        commits and formats the notifications. When done it invokes
+        Scheduler.run_callback, which just sends these on main thread.
     '''
 
+    TICKS_PER_PERIOD = 10
+
     def __init__(self, repos, fetch_done_cb):
         self._fetch_done_cb = fetch_done_cb
         self._repos = repos
         self.log = log.getPluginLogger('git.conf')
         self.fetcher = None
+        self._targeted = {}
+        self._queued = set()
         self.reset()
 
     fetching_alive = \
@@ -517,21 +2052,34 @@ class _Scheduler(object):
             self.log.debug("Scheduling: ignoring reset with pollPeriod 0")
             return
         schedule.addPeriodicEvent(lambda: _Scheduler.start_fetch(self),
-                                  pollPeriod,
+                                  self._get_tick(pollPeriod),
                                  'repofetch',
                                   not self.fetching_alive)
         self.log.debug("Restarted polling")
 
+    def _get_tick(self, pollPeriod):
+        '''
+        Return time between start_fetch ticks, a part of the shortest poll
+        period in use but at least one second.
+        '''
+        periods = [r.options.poll_period for r in self._repos.get()]
+        if config.global_option('adaptivePolling').value:
+            periods.append(config.global_option('minPollPeriod').value)
+        shortest = min([pollPeriod] + [p for p in periods if p > 0])
+        return max(1.0, shortest / float(self.TICKS_PER_PERIOD))
+
     def stop(self):
         '''
         Stop  the gitFetcher. Never allow an exception to propagate since
         this is called in die()
         '''
         # pylint: disable=W0703
-        if self.fetching_alive:
+        fetchers = [f for f in [self.fetcher] + self._targeted.values()
+                        if f and f.is_alive()]
+        for fetcher in fetchers:
             try:
-                self.fetcher.stop()
-                self.fetcher.join()    # This might take time, but it's safest.
+                fetcher.stop()
+                fetcher.join()         # This might take time, but it's safest.
             except Exception, e:
                 self.log.error('Stopping fetcher: %s' % str(e),
                                exc_info=True)
@@ -542,13 +2090,52 @@ class _Scheduler(object):
         if not config.global_option('pollPeriod').value:
             return
         if self.fetching_alive:
-            self.log.error("Fetcher running when about to start!")
-            self.fetcher.stop()
-            self.fetcher.join()
-            self.log.info("Stopped fetcher")
-        self.fetcher = _GitFetcher(self._repos, self._fetch_done_cb)
+            self.log.debug("Fetcher still running, skipping this round.")
+            return
+        if not [r for r in self._repos.get()
+                    if r.poll_timer.due() and r.breaker.allow()]:
+            return
+        self.fetcher = self._get_engine()(self._repos, self._fetch_done_cb)
         self.fetcher.start()
 
+    @staticmethod
+    def _get_engine():
+        ''' Return the fetcher class selected by the fetchEngine option. '''
+        if config.global_option('fetchEngine').value == 'events':
+            return _EventFetcher
+        return _GitFetcher
+
+    def fetch_now(self, repository):
+        '''
+        Fetch and poll repository right away in a separate GitFetcher,
+        not waiting for the periodic fetch. Used for push notifications.
+        If such a fetch of repository is already running, another one is
+        started when it's done.
+        '''
+        name = repository.name
+        self._targeted = dict([(n, f) for n, f in self._targeted.items()
+                                   if f.is_alive()])
+        if name in self._targeted:
+            self._queued.add(name)
+            return
+
+        def fetch_done_cb(notifications):
+            ''' Send notifications, start fetch queued meanwhile if any. '''
+            self._fetch_done_cb(notifications)
+            # The fetcher thread may still be alive, exiting.
+            if self._targeted.get(name) is fetcher:
+                del self._targeted[name]
+            if name in self._queued:
+                self._queued.remove(name)
+                self.fetch_now(repository)
+
+        fetcher = self._get_engine()(self._repos, fetch_done_cb, [repository])
+        if world.testing:
+            fetcher.run()
+            return
+        self._targeted[name] = fetcher
+        fetcher.start()
+
     @staticmethod
     def run_callback(callback, id_):
         ''' Run the callback 'now' on main thread. '''
@@ -569,12 +2156,25 @@ class Git(callbacks.PluginRegexp):
     def __init__(self, irc):
         callbacks.PluginRegexp.__init__(self, irc)
         self.repos = _Repos()
-        fetch_done_cb = lambda: _poll_all_repos(self.repos.get())
-        self.scheduler = _Scheduler(self.repos, fetch_done_cb)
+        self.scheduler = _Scheduler(self.repos, _send_notifications)
+        self.notify_server = None
+        if config.global_option('notifyPort').value:
+            try:
+                self.notify_server = _NotifyServer(self.repos, self.scheduler)
+                self.notify_server.start()
+            except socket.error as e:
+                self.log.error("Cannot listen for notifications: " + str(e))
         if hasattr(irc, 'reply'):
             n = len(self.repos.get())
             irc.reply('Git reinitialized with %s.' % nItems(n, 'repository'))
 
+    def _poll(self, repositories, throw = False):
+        ''' Poll repositories, send notifications, persist heads. '''
+        try:
+            _send_notifications(_poll_all_repos(repositories, throw))
+        finally:
+            self.repos.save_heads()
+
     def _parse_repo(self, irc, msg, repo, channel):
         """ Parse first parameter as a repo, return repository or None. """
         matches = filter(lambda r: r.name == repo, self.repos.get())
@@ -593,6 +2193,8 @@ class Git(callbacks.PluginRegexp):
 
     def die(self):
         ''' Stop all threads.  '''
+        if self.notify_server:
+            self.notify_server.stop()
         self.scheduler.stop()
         callbacks.PluginRegexp.die(self)
 
@@ -605,10 +2207,13 @@ class Git(callbacks.PluginRegexp):
         repositories = [r for r in self.repos.get()
                             if channel in r.options.channels]
         for repository in repositories:
-            if not repository.options.enable_snarf:
+            if not repository.options.enable_snarf or repository.warming:
+                continue
+            hexsha = repository.sha_index.lookup(sha)
+            if not hexsha:
                 continue
             try:
-                commit = repository.get_commit(sha)
+                commit = repository.get_commit(hexsha)
             except git.exc.BadObject:
                 continue
             ctx = _DisplayCtx(irc, channel, repository, _DisplayCtx.SNARF)
@@ -624,6 +2229,9 @@ class Git(callbacks.PluginRegexp):
         repository = self._parse_repo(irc, msg, repo, channel)
         if not repository:
             return
+        if repository.warming:
+            irc.reply('Repository is warming up, please try again later.')
+            return
         if not branch in repository.branches:
             irc.reply('No such branch being watched: ' + branch)
             irc.reply('Available branches: ' +
@@ -635,7 +2243,8 @@ class Git(callbacks.PluginRegexp):
             self.log.info("Cant get branch commit", exc_info=True)
             irc.reply("Internal error retrieving repolog data")
             return
-        commits = repository.get_recent_commits(branch_head, count)[::-1]
+        commits = repository.get_recent_commits(branch_head.hexsha,
+                                                count)[::-1]
         ctx = _DisplayCtx(irc, channel, repository, _DisplayCtx.REPOLOG)
         ctx.display_commits({branch: commits})
 
@@ -659,7 +2268,8 @@ class Git(callbacks.PluginRegexp):
             irc.reply(fmt % {
                 'name': r.name,
                 'url': r.options.url,
-                'branch': nItems(len(r.branches), 'branch')
+                'branch': ('warming up' if r.warming else
+                           nItems(len(r.branches), 'branch'))
             })
 
     repolist = wrap(repolist, ['channel'])
@@ -672,7 +2282,15 @@ class Git(callbacks.PluginRegexp):
         repository = self._parse_repo(irc, msg, repo, channel)
         if not repository:
             return
-        irc.reply('Watched branches: ' + ', '.join(repository.branches))
+        if repository.warming:
+            irc.reply('Repository is warming up.')
+        else:
+            irc.reply('Watched branches: ' + ', '.join(repository.branches))
+        if repository.breaker.state != _CircuitBreaker.CLOSED:
+            irc.reply('Fetch state: ' + str(repository.breaker))
+        irc.reply('Poll: ' + str(repository.poll_timer))
+        irc.reply('Lock: ' + str(repository.lock))
+        irc.reply('Commit cache: ' + str(repository.commit_cache))
 
     repostat = wrap(repostat, ['channel', 'somethingWithoutSpaces'])
 
@@ -681,7 +2299,12 @@ class Git(callbacks.PluginRegexp):
 
         Display overall common configuration for all repositories.
         """
-        for option in ['maxCommitsAtOnce', 'pollPeriod', 'repoDir']:
+        for option in ['maxCommitsAtOnce', 'pollPeriod', 'repoDir',
+                       'fetchWorkers', 'fetchesPerHost', 'probeBeforeFetch',
+                       'maxBackoff', 'commitCacheSize', 'cloneFilter',
+                       'adaptivePolling', 'minPollPeriod', 'maxPollPeriod',
+                       'pollJitter', 'notifyPort', 'notifyAddress',
+                       'fetchEngine']:
             irc.reply(option + ': ' + str(config.global_option(option)))
 
     gitconf = wrap(gitconf, [])
@@ -705,6 +2328,19 @@ class Git(callbacks.PluginRegexp):
 
     repoconf = wrap(repoconf, ['channel', 'somethingWithoutSpaces'])
 
+    def reporeload(self, irc, msg, args):
+        """ Takes no arguments
+
+        Apply changed configuration. Only repositories with a new url or
+        branches setting are restarted, other settings are updated in place.
+        """
+        restarted = self.repos.reload()
+        self.scheduler.reset()
+        irc.reply('Configuration reloaded, %s restarted.' %
+                  nItems(len(restarted), 'repository'))
+
+    reporeload = wrap(reporeload, ['owner'])
+
     def repopoll(self, irc, msg, args, channel, repo):
         """ [repository name]
 
@@ -718,7 +2354,7 @@ class Git(callbacks.PluginRegexp):
         else:
             repos = self.repos.get()
         try:
-            _poll_all_repos(repos, throw = True)
+            self._poll(repos, throw = True)
             irc.replySuccess()
         except Exception as e:              # pylint: disable=W0703
             irc.reply('Error: ' + str(e))
@@ -781,7 +2417,7 @@ class Git(callbacks.PluginRegexp):
             irc.reply('Error: repo does not exist')
             return
         self.repos.remove(found_repos[0])
-        shutil.rmtree(found_repos[0].path)
+        found_repos[0].remove()
         irc.reply('Repository deleted')
 
     repokill = wrap(repokill,
@@ -38,10 +38,15 @@
 
 from supybot.test import *
 from supybot import conf
+from supybot import schedule
 
 import git
 import os
+import shutil
+import sys
+import tempfile
 import time
+import urllib2
 
 SRC_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(SRC_DIR, 'test-data')
@@ -50,6 +55,9 @@ DATA_DIR = os.path.join(SRC_DIR, 'test-data')
 # are not getting responses, you may need to bump this higher.
 LOOP_TIMEOUT = 0.1
 
+# Port used by the push notification tests.
+NOTIFY_PORT = 18093
+
 
 # Pre-test checks
 GIT_API_VERSION = int(git.__version__[2])
@@ -85,6 +93,14 @@ class PluginTestCaseUtilMixin(object):
                          ('\n'.join(responses), '\n'.join(expectedResponses)))
         return responses
 
+    def run_fetcher(self, cls='_GitFetcher'):
+        "Run one fetch of all repositories, return list of notifications."
+        plugin = self.irc.getCallback('Git')
+        module = sys.modules[plugin.__class__.__module__]
+        notifications = []
+        getattr(module, cls)(plugin.repos, notifications.extend).run()
+        return notifications
+
     def clear_repos(self):
         "Remove all defined repositories."
         plugin_group = conf.supybot.plugins.get('Git')
@@ -159,6 +175,28 @@ class GitRepositoryListTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         ]
         self.assertResponses('repolist', expected)
 
+    def testReloadChannels(self):
+        conf.supybot.plugins.Git.repos.test3.channels.setValue(['#other'])
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        expected = [
+            '\x02test1\x02  plugins/Git/test-data/git-repo 4 branches',
+            '\x02test2\x02  plugins/Git/test-data/git-repo 4 branches',
+        ]
+        self.assertResponses('repolist', expected)
+
+    def testReloadBranches(self):
+        conf.supybot.plugins.Git.repos.test2.branches.setValue('test*')
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 1 repository restarted.')
+        expected = [
+            '\x02test1\x02  plugins/Git/test-data/git-repo 4 branches',
+            '\x02test2\x02  plugins/Git/test-data/git-repo 2 branches',
+            '\x02test3\x02  plugins/Git/test-data/git-repo 4 branches',
+        ]
+        self.assertResponses('repolist', expected)
+
 
 class GitNoAccessTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#unused'
@@ -256,6 +294,22 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         ]
         self.assertResponses('repolog test2 feature 5', expected)
 
+    def testLogFormat(self):
+        conf.supybot.plugins.Git.repos.test2.commitMessage1.setValue(
+            '%![%n%!|%(4)%c%r]%S%m 100%% %x%(2')
+        conf.supybot.plugins.Git.repos.test2.commitMessage2.setValue(
+            '%C %e %f %d')
+        self.assertResponses('reload Git', [
+            'Git reinitialized with 2 repositories.',
+            'The operation succeeded.'
+        ])
+        expected = [
+            '\x02[test2\x02|\x034f271e28\x0f] Snarks and grumpkins 100% x',
+            'f271e28ebbc02af5d795146fde4705ad48a87282'
+            ' tlannister@westerlands.7k 1 +1 -0',
+        ]
+        self.assertResponses('repolog test2 feature', expected)
+
     def testSnarf(self):
         expected = [
             "Talking about cbe46d8?",
@@ -265,6 +319,65 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponses('What about cbe46d8?', expected,
                              usePrefixChar=False)
 
+    def testObjectStoreRelativeUrl(self):
+        conf.supybot.plugins.Git.repos.test2.objectStore.setValue('westeros')
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        repos = self.irc.getCallback('Git').repos.get()
+        repository = [r for r in repos if r.name == 'test2'][0]
+        repository._clone()
+        repository.init()
+        self.assertTrue(os.path.exists(os.path.join(
+            repository.path, 'objects', 'info', 'alternates')))
+        expected = ['[test2|feature|Tyrion Lannister] Snarks and grumpkins']
+        self.assertResponses('repolog test2 feature', expected)
+
+    def testWarmUpKeepsClone(self):
+        repos = self.irc.getCallback('Git').repos.get()
+        repository = [r for r in repos if r.name == 'test2'][0]
+        marker = os.path.join(repository.path, 'marker')
+        open(marker, 'w').close()
+        repository.warming = True
+        repository.warm_up()
+        self.assertFalse(repository.warming)
+        self.assertTrue(os.path.exists(marker))
+
+    def testWarmingUp(self):
+        repos = self.irc.getCallback('Git').repos.get()
+        repository = [r for r in repos if r.name == 'test2'][0]
+        repository.warming = True
+        self.assertResponses('repolist', [
+            '\x02test2\x02  plugins/Git/test-data/git-repo warming up'])
+        self.assertResponses('repostat test2', [
+            'Repository is warming up.',
+            'Poll: not yet polled',
+            'Lock: ' + str(repository.lock),
+            'Commit cache: ' + str(repository.commit_cache)
+        ])
+        self.assertResponses('repolog test2 feature', [
+            'Repository is warming up, please try again later.'])
+        self.assertSnarfNoResponse('What about cbe46d8?', timeout=0.5)
+        repository.warm_up()
+        self.assertResponses('repolist', [
+            '\x02test2\x02  plugins/Git/test-data/git-repo 4 branches'])
+        self.assertResponses('repolog test2 feature', [
+            '[test2|feature|Tyrion Lannister] Snarks and grumpkins'])
+
+    def testSnarfCached(self):
+        repos = self.irc.getCallback('Git').repos.get()
+        repository = [r for r in repos if r.name == 'test2'][0]
+        self.assertSnarfResponse('What about cbe46d8?',
+                                 'Talking about cbe46d8?')
+        self.getMsg(' ')
+        hits = repository.commit_cache.hits
+        misses = repository.commit_cache.misses
+        self.assertSnarfResponse('What about cbe46d8?',
+                                 'Talking about cbe46d8?')
+        self.getMsg(' ')
+        self.assertEqual(repository.commit_cache.hits, hits + 1)
+        self.assertEqual(repository.commit_cache.misses, misses)
+
 
 class GitKillTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#test'
@@ -346,5 +459,344 @@ class GitBranchTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponse('repostat test2', expected)
 
 
+class GitPollTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
+    channel = '#test'
+    plugins = ('Git',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
+        self.clear_repos()
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmpdir, 'upstream')
+        self.workdir = os.path.join(self.tmpdir, 'work')
+        git.Git(self.tmpdir).clone(os.path.join(DATA_DIR, 'git-repo'),
+                                   self.upstream, bare=True)
+        git.Git(self.tmpdir).clone(self.upstream, self.workdir)
+        work = git.Git(self.workdir)
+        work.config('user.name', 'Arya Stark')
+        work.config('user.email', 'arya@winterfell.7k')
+        self.assertNotError('repoadd test1 %s #test' % self.upstream)
+        self.getMsg(' ')
+
+    def tearDown(self):
+        self.clear_repos()
+        ChannelPluginTestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def push(self, *messages):
+        work = git.Git(self.workdir)
+        for message in messages:
+            work.commit(allow_empty=True, message=message)
+        work.push('origin', 'master')
+
+    def fetch(self):
+        for repository in self.irc.getCallback('Git').repos.get():
+            repository.fetch()
+
+    def testCloneBare(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        self.assertTrue(git.Repo(repository.path).bare)
+
+    def testObjectStore(self):
+        conf.supybot.plugins.Git.repos.test1.objectStore.setValue('westeros')
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        repository._clone()
+        repository.init()
+        alternates = os.path.join(repository.path,
+                                  'objects', 'info', 'alternates')
+        store = os.path.join(conf.supybot.plugins.Git.repoDir(),
+                             '.stores', 'westeros')
+        with open(alternates) as f:
+            self.assertEqual(f.read().strip(),
+                             os.path.join(os.path.abspath(store), 'objects'))
+        self.assertEqual(git.Git(store).config('gc.auto'), '0')
+        self.assertEqual(git.Git(store).config('gc.pruneExpire'), 'never')
+        self.push('Winter is coming')
+        self.fetch()
+        expected = [
+            'Arya Stark pushed 1 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Winter is coming',
+            'The operation succeeded.'
+        ]
+        self.assertResponses('repopoll', expected)
+        repository.remove()
+        self.assertFalse(git.Git(store).for_each_ref('refs/repos'))
+
+    def testFetchTimeout(self):
+        conf.supybot.plugins.Git.repos.test1.fetchTimeout.setValue(1)
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        git.Git(repository.path).config('remote.origin.uploadpack',
+                                        'sleep 30; git-upload-pack')
+        start = time.time()
+        self.run_fetcher()
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual(repository.breaker.failures, 1)
+        self.assertTrue(
+            repository.breaker.last_error.startswith('Timeout (1 s) in: '))
+
+    def testCircuitBreaker(self):
+        conf.supybot.plugins.Git.maxBackoff.setValue(90)
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        breaker = repository.breaker
+        clone = git.Git(repository.path)
+        clone.config('remote.origin.url', os.path.join(self.tmpdir, 'gone'))
+        try:
+            self.run_fetcher()
+            self.assertEqual(breaker.state, breaker.OPEN)
+            self.assertAlmostEqual(breaker.retry_at - time.time(), 60,
+                                   delta=5)
+            self.run_fetcher()
+            self.assertEqual(breaker.failures, 1)
+            breaker.retry_at = 0
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            self.run_fetcher()
+            self.assertEqual(breaker.failures, 2)
+            self.assertAlmostEqual(breaker.retry_at - time.time(), 90,
+                                   delta=5)
+            clone.config('remote.origin.url', self.upstream)
+            breaker.retry_at = 0
+            self.run_fetcher()
+            self.assertEqual(breaker.state, breaker.CLOSED)
+        finally:
+            conf.supybot.plugins.Git.maxBackoff.setValue(3600)
+
+    def testWarmUpInProgress(self):
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        repository.warming = True
+        with repository.lock:
+            self.run_fetcher()
+        self.assertTrue(repository.warming)
+        self.assertFalse(repository.breaker.failures)
+        self.run_fetcher()
+        self.assertFalse(repository.warming)
+
+    def testFetchSameUrl(self):
+        self.assertNotError('repoadd test2 %s/ #test' % self.upstream)
+        self.getMsg(' ')
+        self.push('Winter is coming')
+        sha = git.Git(self.workdir).rev_parse('HEAD')
+        self.run_fetcher()
+        test1, test2 = self.irc.getCallback('Git').repos.get()
+        self.assertEqual(test1.commit_by_branch['master'], sha)
+        self.assertEqual(test2.commit_by_branch['master'], sha)
+        with open(os.path.join(test2.path, 'FETCH_HEAD')) as f:
+            self.assertTrue(os.path.abspath(test1.path) in f.read())
+
+    def testFetchSameUrlFilter(self):
+        git.Git(self.upstream).config('uploadpack.allowFilter', 'true')
+        url = 'file://' + self.upstream
+        self.assertNotError('repoadd test2 %s #test' % url)
+        self.getMsg(' ')
+        self.assertNotError('repoadd test3 %s/ #test' % url)
+        self.getMsg(' ')
+        self.push('Winter is coming')
+        sha = git.Git(self.workdir).rev_parse('HEAD')
+        self.run_fetcher()
+        test1, test2, test3 = self.irc.getCallback('Git').repos.get()
+        self.assertEqual(test3._get_clone_filter(), 'blob:none')
+        self.assertEqual(test3.commit_by_branch['master'], sha)
+        with open(os.path.join(test3.path, 'FETCH_HEAD')) as f:
+            self.assertTrue(os.path.abspath(test2.path) in f.read())
+        promisors = git.Git(test3.path).config('--get-regexp',
+                                               r'\.promisor$')
+        self.assertEqual(sorted([line.split()[0]
+                                     for line in promisors.splitlines()]),
+                         ['remote.dedup.promisor', 'remote.origin.promisor'])
+
+    def testAdaptivePoll(self):
+        conf.supybot.plugins.Git.adaptivePolling.setValue(True)
+        conf.supybot.plugins.Git.repos.test1.pollPeriod.setValue(120)
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        try:
+            self.push('Winter is coming')
+            self.run_fetcher()
+            self.assertEqual(repository.poll_timer.interval, 60)
+            self.assertFalse(repository.poll_timer.due())
+            repository.poll_timer.next_at = 0
+            self.run_fetcher()
+            self.assertEqual(repository.poll_timer.interval, 90)
+        finally:
+            conf.supybot.plugins.Git.adaptivePolling.setValue(False)
+
+    def testPollDueNextTick(self):
+        conf.supybot.plugins.Git.pollJitter.setValue(0)
+        conf.supybot.plugins.Git.repos.test1.pollPeriod.setValue(120)
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        plugin = self.irc.getCallback('Git')
+        timer = plugin.repos.get()[0].poll_timer
+        try:
+            start = time.time()
+            self.run_fetcher()
+            self.assertTrue(timer.next_at < time.time() + 120)
+            tick = plugin.scheduler._get_tick(120)
+            self.assertEqual(tick, 12)
+            self.assertFalse(timer.due(start + 120 - tick))
+            self.assertTrue(timer.due(start + 120))
+        finally:
+            conf.supybot.plugins.Git.pollJitter.setValue(10)
+
+    def testNotify(self):
+        conf.supybot.plugins.Git.notifyPort.setValue(NOTIFY_PORT)
+        try:
+            self.assertResponses('reload Git', [
+                'Git reinitialized with 1 repository.',
+                'The operation succeeded.'
+            ])
+            repository = self.irc.getCallback('Git').repos.get()[0]
+            self.push('Winter is coming')
+            sha = git.Git(self.workdir).rev_parse('HEAD')
+            url = 'http://127.0.0.1:%d/test1' % NOTIFY_PORT
+            hook_input = '%s %s refs/tags/v1\n' % ('0' * 40, sha)
+            self.assertRaises(urllib2.HTTPError,
+                              urllib2.urlopen, url, hook_input)
+            hook_input = '%s %s refs/heads/master\n' % ('0' * 40, sha)
+            self.assertEqual(urllib2.urlopen(url, hook_input).read(),
+                             'test1\n')
+            schedule.run()
+            self.assertEqual(repository.commit_by_branch['master'], sha)
+            self.assertResponses(' ', [
+                'Arya Stark pushed 1 commit(s) to master at test1',
+                '[test1|master|Arya Stark] Winter is coming'
+            ])
+        finally:
+            conf.supybot.plugins.Git.notifyPort.setValue(0)
+
+    def testEventFetcher(self):
+        self.assertNotError('repoadd test2 %s #test' % self.upstream)
+        self.getMsg(' ')
+        self.push('Winter is coming')
+        sha = git.Git(self.workdir).rev_parse('HEAD')
+        notifications = self.run_fetcher('_EventFetcher')
+        schedule.run()
+        for repository in self.irc.getCallback('Git').repos.get():
+            self.assertEqual(repository.commit_by_branch['master'], sha)
+            self.assertFalse(repository.breaker.failures)
+        self.assertEqual(len(notifications), 4)
+
+    def testPollNothing(self):
+        self.fetch()
+        self.assertResponses('repopoll', ['The operation succeeded.'])
+
+    def testPoll(self):
+        self.push('Winter is coming')
+        self.fetch()
+        expected = [
+            'Arya Stark pushed 1 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Winter is coming',
+            'The operation succeeded.'
+        ]
+        self.assertResponses('repopoll', expected)
+        self.assertResponses('repopoll', ['The operation succeeded.'])
+
+    def testPollChannels(self):
+        self.irc.feedMsg(ircmsgs.join('#other', prefix=self.prefix))
+        self.irc.takeMsg()
+        self.irc.takeMsg()
+        conf.supybot.plugins.Git.repos.test1.channels.set('#test #other')
+        self.assertResponse('reporeload',
+                            'Configuration reloaded, 0 repositories'
+                            ' restarted.')
+        self.push('Winter is coming')
+        self.fetch()
+        responses = self._feedMsgLoop('repopoll')
+        lines = [
+            'Arya Stark pushed 1 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Winter is coming'
+        ]
+        expected = [(channel, line)
+                        for channel in ['#test', '#other'] for line in lines]
+        expected.append(('#test', 'The operation succeeded.'))
+        self.assertEqual(sorted([tuple(m.args) for m in responses]),
+                         sorted(expected))
+
+    def testPollLockStats(self):
+        self.fetch()
+        self.assertResponses('repopoll', ['The operation succeeded.'])
+        repository = self.irc.getCallback('Git').repos.get()[0]
+        self.assertEqual(repository.lock.count, 1)
+        self.assertResponses('repostat test1', [
+            'Watched branches: test1, test2, master, feature',
+            'Poll: not yet polled',
+            'Lock: ' + str(repository.lock),
+            'Commit cache: ' + str(repository.commit_cache)
+        ])
+        self.assertTrue(str(repository.lock).startswith('held 1 time, '))
+
+    def testPollMany(self):
+        self.push('One', 'Two', 'Three', 'Four', 'Five')
+        self.fetch()
+        expected = [
+            'Showing latest 3 of 5 commits to test1...',
+            'Arya Stark pushed 3 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Five',
+            '[test1|master|Arya Stark] Four',
+            '[test1|master|Arya Stark] Three',
+            'The operation succeeded.'
+        ]
+        self.assertResponses('repopoll', expected)
+
+    def testPollAuthors(self):
+        work = git.Git(self.workdir)
+        work.checkout('test2')
+        os.environ['GIT_COMMITTER_DATE'] = '@1000000000 +0000'
+        try:
+            work.commit(allow_empty=True,
+                        message='You know nothing',
+                        author='Ygritte <ygritte@north.7k>')
+        finally:
+            del os.environ['GIT_COMMITTER_DATE']
+        work.push('origin', 'test2')
+        work.checkout('master')
+        self.push('One', 'Two', 'Three')
+        self.fetch()
+        expected = [
+            'Showing latest 3 of 4 commits to test1...',
+            'Arya Stark pushed 3 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Three',
+            '[test1|master|Arya Stark] Two',
+            '[test1|master|Arya Stark] One',
+            'The operation succeeded.'
+        ]
+        self.assertResponses('repopoll', expected)
+
+    def testSnarfNew(self):
+        self.push('Winter is coming')
+        sha = git.Git(self.workdir).rev_parse('HEAD')[0:7]
+        self.assertSnarfNoResponse('What about %s?' % sha, timeout=0.5)
+        self.fetch()
+        expected = [
+            "Talking about %s?" % sha,
+            "I. e., [test1|Arya Stark] Winter is coming",
+        ]
+        self.assertResponses('What about %s?' % sha, expected,
+                             usePrefixChar=False)
+
+    def testPollAfterReload(self):
+        self.push('Winter is coming')
+        self.assertResponses('reload Git', [
+            'Git reinitialized with 1 repository.',
+            'The operation succeeded.'
+        ])
+        self.fetch()
+        expected = [
+            'Arya Stark pushed 1 commit(s) to master at test1',
+            '[test1|master|Arya Stark] Winter is coming',
+            'The operation succeeded.'
+        ]
+        self.assertResponses('repopoll', expected)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: